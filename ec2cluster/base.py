@@ -1,20 +1,28 @@
 import json
 import boto
+import boto.ec2
 from boto.utils import get_instance_userdata, get_instance_metadata
 from boto.route53.record import ResourceRecordSets
 import dns
 import dns.resolver
 import os
-import subprocess
+import threading
+import time
 import psycopg2
 import logging
 from crontab import CronTab
 
 #from ec2cluster import default_settings as settings
 from ec2cluster import settings
+from ec2cluster import events
+from ec2cluster.runner import CommandRunner, CommandError, CommandTimeout
+from ec2cluster.utils import lsn_to_int, switch_point_to_int
 
 
 class EC2Mixin(object):
+    # EC2 states of instances which can no longer serve reads
+    GONE_STATES = ('shutting-down', 'terminated', 'stopping', 'stopped')
+
     def get_metadata(self):
         data = get_instance_metadata()
         data.update(json.loads(get_instance_userdata()))
@@ -24,6 +32,24 @@ class EC2Mixin(object):
         return boto.connect_route53(aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
             aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY)
 
+    def _get_ec2_conn(self):
+        region = self.metadata['placement']['availability-zone'][:-1]
+        return boto.ec2.connect_to_region(region, aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY)
+
+    def get_instance_states(self, instance_ids):
+        """ Returns a dict of instance-id to EC2 state (e.g. 'running'). Instances which no
+            longer exist are not included.
+        """
+        if not instance_ids:
+            return {}
+        ec2_conn = self._get_ec2_conn()
+        states = {}
+        for reservation in ec2_conn.get_all_instances(filters={'instance-id': list(instance_ids)}):
+            for instance in reservation.instances:
+                states[instance.id] = instance.state
+        return states
+
     def acquire_master_cname(self, force=False):
         """ Use Route53 to update the master_cname record to point to this instance.
 
@@ -61,6 +87,152 @@ class EC2Mixin(object):
         add_record.add_value(self.metadata['public-hostname'])
         changes.commit()
         self.logger.info('Finished updating DNS records')
+        self.fire_event(events.DNS_UPDATED, cname=self.master_cname,
+            hostname=self.metadata['public-hostname'], action='set')
+
+    def _get_cluster_records(self, route53_conn, cname=None):
+        """ Returns the master and slave CNAME records for this cluster, found with a
+            single (paginated) listing of the hosted zone. The slave CNAME has one
+            weighted record per instance in the pool.
+
+            If cname is given, only the records for that CNAME are returned.
+        """
+        if cname is None:
+            names = ('%s.' % self.master_cname, '%s.' % self.slave_cname)
+        else:
+            names = ('%s.' % cname, )
+        return [record for record in route53_conn.get_all_rrsets(settings.ROUTE53_ZONE_ID)
+            if record.type == 'CNAME' and record.name in names]
+
+    def _delete_record(self, changes, record):
+        """ Adds a change to delete record, as returned by _get_cluster_records, to changes.
+        """
+        del_record = changes.add_change('DELETE',
+            record.name.rstrip('.'),
+            'CNAME',
+            ttl=record.ttl,
+            weight=record.weight,
+            identifier=record.identifier)
+        for value in record.resource_records:
+            del_record.add_value(value)
+
+    def reconcile_dns(self, dry_run=False, force=False):
+        """ Compares the master and slave CNAMEs with the roles the instances they point
+            to actually have, and corrects the records in a single Route53 change batch:
+
+            * slave pool records are removed if the instance is a live master, or if it
+              is not a live slave and EC2 reports it as stopped or terminated
+            * the master CNAME is moved if it does not point to a live master, and exactly
+              one of the instances in DNS is a live master
+
+            Removing every instance from the slave pool is refused unless force is True,
+            as nothing adds them back.
+
+            Returns a list of (action, cname, hostname) tuples describing the changes. If
+            dry_run is True the changes are logged but not applied.
+        """
+        route53_conn = self._get_route53_conn()
+        records = self._get_cluster_records(route53_conn)
+        hostnames = set()
+        for record in records:
+            hostnames.update([value.rstrip('.') for value in record.resource_records])
+        roles = self.probe_roles(hostnames)
+
+        master_records = [record for record in records if record.name != '%s.' % self.slave_cname]
+        slave_records = [record for record in records if record.name == '%s.' % self.slave_cname]
+        # The identifier of a slave pool record is the instance-id
+        states = self.get_instance_states([record.identifier for record in slave_records])
+
+        changes = ResourceRecordSets(route53_conn, settings.ROUTE53_ZONE_ID)
+        summary = []
+        # Slave pool members which are not live masters, and how many of them are removed
+        slave_candidates = 0
+        dead_slaves = 0
+        for record in slave_records:
+            hostname = record.resource_records[0].rstrip('.')
+            role = roles.get(hostname)
+            if role != self.MASTER:
+                slave_candidates += 1
+            if role == self.SLAVE:
+                continue
+            state = states.get(record.identifier, 'terminated')
+            if role is None and state not in self.GONE_STATES:
+                # Probes can fail for reasons other than the instance being dead, e.g.
+                # authentication errors or a network partition
+                self.logger.warning('Could not probe %s, but %s is %s - leaving it in the slave pool' % (
+                    hostname, record.identifier, state))
+                continue
+            self.logger.warning('%s is in the slave pool but is not a live slave (%s is %s)' % (
+                hostname, record.identifier, state))
+            self._delete_record(changes, record)
+            summary.append(('remove', self.slave_cname, hostname))
+            if role != self.MASTER:
+                dead_slaves += 1
+
+        # A promoted slave leaving the pool is expected, so it does not count as emptying it
+        if slave_candidates and dead_slaves == slave_candidates and not force:
+            self.logger.critical('Refusing to remove every instance from the slave pool without force')
+            raise Exception('Reconciling would empty the slave pool for %s' % self.slave_cname)
+
+        current_master = None
+        if master_records:
+            current_master = master_records[0].resource_records[0].rstrip('.')
+        if current_master is None or roles.get(current_master) != self.MASTER:
+            masters = sorted([hostname for hostname, role in roles.items() if role == self.MASTER])
+            if len(masters) == 1:
+                self.logger.warning('%s points to %s, which is not a live master' % (self.master_cname, current_master))
+                for record in master_records:
+                    self._delete_record(changes, record)
+                add_record = changes.add_change('CREATE', self.master_cname, 'CNAME', ttl=settings.MASTER_CNAME_TTL)
+                add_record.add_value(masters[0])
+                summary.append(('set', self.master_cname, masters[0]))
+            else:
+                # Taking the CNAME away would make new instances think they are the master
+                self.logger.critical('%s does not point to a live master, and %s live masters were found - not changing it' % (
+                    self.master_cname, len(masters)))
+
+        if not summary:
+            self.logger.info('DNS records for %s are consistent' % self.metadata['cluster'])
+            return summary
+        for action, cname, hostname in summary:
+            self.logger.info('%s%s %s for %s' % ('(dry run) ' if dry_run else '', action, hostname, cname))
+        if not dry_run:
+            changes.commit()
+            self.logger.info('Finished updating DNS records')
+            for action, cname, hostname in summary:
+                self.fire_event(events.DNS_UPDATED, cname=cname, hostname=hostname, action=action)
+        return summary
+
+    def move_master_cname(self, hostname):
+        """ Points the master CNAME at hostname and removes hostname from the slave
+            CNAME pool. All changes are submitted to Route53 in a single batch, so
+            clients never see a state where no (or two) masters are advertised.
+        """
+        route53_conn = self._get_route53_conn()
+        changes = ResourceRecordSets(route53_conn, settings.ROUTE53_ZONE_ID)
+        records = self._get_cluster_records(route53_conn)
+
+        for record in records:
+            if record.name != '%s.' % self.master_cname:
+                continue
+            self.logger.info('Deleting existing record for %s' % self.master_cname)
+            self._delete_record(changes, record)
+
+        self.logger.info('Creating record for %s pointing to %s' % (self.master_cname, hostname))
+        add_record = changes.add_change('CREATE', self.master_cname, 'CNAME', ttl=settings.MASTER_CNAME_TTL)
+        add_record.add_value(hostname)
+
+        for record in records:
+            if record.name != '%s.' % self.slave_cname:
+                continue
+            if hostname not in [value.rstrip('.') for value in record.resource_records]:
+                continue
+            self.logger.info('Removing %s from CNAME pool for %s' % (record.identifier, self.slave_cname))
+            self._delete_record(changes, record)
+
+        changes.commit()
+        self.logger.info('Finished updating DNS records')
+        self.fire_event(events.DNS_UPDATED, cname=self.master_cname, hostname=hostname, action='set')
 
     def add_to_slave_cname_pool(self):
         """ Add this instance to the pool of hostnames for slave.<cluster name>.goteam.be.
@@ -89,6 +261,8 @@ class EC2Mixin(object):
             else:
                 raise
         self.logger.info('Finished updating DNS records')
+        self.fire_event(events.DNS_UPDATED, cname=self.slave_cname,
+            hostname=self.metadata['public-hostname'], action='add')
 
     def remove_from_slave_cname_pool(self):
         """ Remove this instance from the pool of slave hostnames, usually after a promotion.
@@ -96,15 +270,18 @@ class EC2Mixin(object):
         route53_conn = self._get_route53_conn()
         changes = ResourceRecordSets(route53_conn, settings.ROUTE53_ZONE_ID)
 
+        records = [record for record in self._get_cluster_records(route53_conn, self.slave_cname)
+            if record.identifier == self.metadata['instance-id']]
+        if not records:
+            self.logger.warning('%s is not in the CNAME pool for %s' % (self.metadata['instance-id'], self.slave_cname))
+            return
+
         self.logger.info('Removing  %s from CNAME pool for %s' % (self.metadata['instance-id'], self.slave_cname))
-        del_record = changes.add_change('DELETE',
-            self.slave_cname,
-            'CNAME',
-            ttl=settings.SLAVE_CNAME_TTL,
-            weight='10',
-            identifier=self.metadata['instance-id'])
-        del_record.add_value(self.metadata['public-hostname'])
+        for record in records:
+            self._delete_record(changes, record)
         changes.commit()
+        self.fire_event(events.DNS_UPDATED, cname=self.slave_cname,
+            hostname=self.metadata['public-hostname'], action='remove')
 
 
 class VagrantMixin(object):
@@ -140,6 +317,8 @@ class BaseCluster(object):
         self.master_cname = self.get_master_cname()
         self.slave_cname = self.get_slave_cname()
         self.roles = self.get_roles()
+        self.events = events.EventBus(events.get_sinks(settings.EVENT_SINKS))
+        self.runner = CommandRunner(self.logger)
 
     def get_roles(self):
         return {
@@ -151,6 +330,7 @@ class BaseCluster(object):
         """ Initialises this server as a master or slave.
         """
         self.role = self.determine_role()
+        self.fire_event(events.ROLE_DETERMINED)
         if self.role in self.roles:
             # Call the function for this role, as declared in get_roles().
             self.roles[self.role]()
@@ -158,10 +338,28 @@ class BaseCluster(object):
             self.logger.critical('Unknown role: %s' % self.role)
             raise Exception('Unrecognised role: %s' % self.role)
 
-        self.start_process()
+        try:
+            self.start_process()
+        except Exception, e:
+            self.logger.critical('Failed to start process: %s' % e)
+            self.fire_event(events.FAILED, error=str(e))
+            self.process_failed()
+            raise
         # Call the hook function
         self.process_started()
 
+    def fire_event(self, name, **data):
+        """ Sends an event to all sinks registered on self.events. Details about this
+            instance are added to the given data.
+        """
+        data.update({
+            'cluster': self.metadata['cluster'],
+            'instance-id': self.metadata['instance-id'],
+            'public-hostname': self.metadata['public-hostname'],
+            'role': getattr(self, 'role', None),
+        })
+        self.events.fire(events.Event(name, data))
+
     def get_master_cname(self):
         """ Returns the CNAME of the master server for this cluster.
         """
@@ -219,6 +417,31 @@ class BaseCluster(object):
         """
         raise NotImplementedError
 
+    def probe_role(self, hostname):
+        """ Returns the role the service on hostname is running in, or None if it is not
+            reachable.
+        """
+        raise NotImplementedError
+
+    def probe_roles(self, hostnames):
+        """ Probes all of hostnames concurrently, returning a dict of hostname to role.
+        """
+        roles = {}
+
+        def probe(hostname):
+            try:
+                roles[hostname] = self.probe_role(hostname)
+            except Exception, e:
+                self.logger.warning('Failed to probe %s: %s' % (hostname, e))
+                roles[hostname] = None
+
+        threads = [threading.Thread(target=probe, args=(hostname, )) for hostname in hostnames]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return roles
+
     def process_started(self):
         pass
 
@@ -238,13 +461,13 @@ class ScriptCluster(VagrantMixin, BaseCluster):
         starts a service via init.d scripts.
     """
     def start_process(self):
-        subprocess.check_call(['/etc/init.d/%s' % SERVICE_NAME, 'start'])
+        self.runner.run(['/etc/init.d/%s' % SERVICE_NAME, 'start'])
 
     def prepare_master(self):
-        subprocess.check_call([MASTER_SCRIPT, ])
+        self.runner.run([MASTER_SCRIPT, ])
 
     def prepare_slave(self):
-        subprocess.check_call([SLAVE_SCRIPT, ])
+        self.runner.run([SLAVE_SCRIPT, ])
 
 
 class PostgresqlCluster(EC2Mixin, BaseCluster):
@@ -256,7 +479,10 @@ class PostgresqlCluster(EC2Mixin, BaseCluster):
         The prepare_[master|slave] functions will put the instance in a state whereby
         '/etc/init.d/postgresql start' can be executed.
     """
-    def _get_conn(self, host=None, dbname=None, user=None):
+    # Printed on the target before it is told to promote, see switchover()
+    PROMOTE_MARKER = 'ec2cluster-promote-started'
+
+    def _get_conn(self, host=None, dbname=None, user=None, connect_timeout=None):
         """ Returns a connection to postgresql server.
         """
         conn_str = ''
@@ -266,6 +492,8 @@ class PostgresqlCluster(EC2Mixin, BaseCluster):
             conn_str += 'dbname=%s ' % dbname
         if user:
             conn_str += 'user=%s ' % user
+        if connect_timeout:
+            conn_str += 'connect_timeout=%s ' % connect_timeout
 
         return psycopg2.connect(conn_str)
 
@@ -282,7 +510,37 @@ class PostgresqlCluster(EC2Mixin, BaseCluster):
     def start_process(self):
         """ Starts postgresql using the init.d scripts.
         """
-        subprocess.check_call(['/etc/init.d/postgresql', 'start'])
+        self.runner.run(['/etc/init.d/postgresql', 'start'], timeout=settings.PG_START_TIMEOUT)
+
+    def _pg_ctl_cmd(self, *args):
+        """ Returns the command to run pg_ctl with args on the local data directory.
+        """
+        return ['sudo', '-u', settings.PG_USER, settings.PG_CTL, '-D', settings.PG_DIR] + list(args)
+
+    def stop_process(self):
+        """ Stops postgresql using fast shutdown mode. Connected clients are
+            disconnected and a shutdown checkpoint is written before this returns.
+        """
+        self.logger.info('Stopping postgresql')
+        self.runner.run(self._pg_ctl_cmd('stop', '-m', 'fast'))
+
+    def is_process_running(self):
+        """ Returns True if postgresql is running on this instance.
+        """
+        return self.runner.run(self._pg_ctl_cmd('status'), check=False).returncode == 0
+
+    def get_control_data(self):
+        """ Returns the output of pg_controldata for the local data directory as a dict.
+        """
+        env = dict(os.environ)
+        env['LC_ALL'] = 'C'
+        output = self.runner.run([settings.PG_CONTROLDATA, settings.PG_DIR], env=env).stdout
+        data = {}
+        for line in output.splitlines():
+            key, sep, value = line.partition(':')
+            if sep:
+                data[key.strip()] = value.strip()
+        return data
 
     def write_recovery_conf(self, template_path):
         """ Using the template specified in settings, create a recovery.conf file in the
@@ -358,18 +616,124 @@ class PostgresqlCluster(EC2Mixin, BaseCluster):
         elif str(res) == '(False,)':
             return True
 
+    def _is_in_recovery(self, conn):
+        cur = conn.cursor()
+        cur.execute('SELECT pg_is_in_recovery()')
+        return cur.fetchone()[0]
+
+    def _wait_for_replay(self, conn, location):
+        """ Polls the slave on conn until it has replayed the WAL record starting at
+            location, or raises an exception after SWITCHOVER_TIMEOUT seconds.
+        """
+        target = lsn_to_int(location)
+        deadline = time.time() + settings.SWITCHOVER_TIMEOUT
+        cur = conn.cursor()
+        while True:
+            cur.execute('SELECT pg_last_xlog_replay_location()')
+            replayed = cur.fetchone()[0]
+            # The replay location is the end of the last replayed record, so it is only
+            # past location once the record starting there has been replayed
+            if replayed is not None and lsn_to_int(replayed) > target:
+                self.logger.info('Slave has replayed up to %s' % replayed)
+                return
+            if time.time() > deadline:
+                raise Exception('Slave only replayed up to %s, expected %s' % (replayed, location))
+            time.sleep(settings.SWITCHOVER_POLL_INTERVAL)
+
+    def _wait_for_promotion(self, conn):
+        """ Polls the server on conn until it has left recovery mode, or raises an
+            exception after SWITCHOVER_PROMOTE_TIMEOUT seconds.
+        """
+        deadline = time.time() + settings.SWITCHOVER_PROMOTE_TIMEOUT
+        while self._is_in_recovery(conn):
+            if time.time() > deadline:
+                raise Exception('Server did not leave recovery mode after promotion')
+            time.sleep(settings.SWITCHOVER_POLL_INTERVAL)
+
+    def _get_timeline(self, conn):
+        """ Returns the timeline the master server on conn is currently writing to.
+        """
+        cur = conn.cursor()
+        # The first 8 characters of a WAL file name are the timeline ID, in hex
+        cur.execute('SELECT substr(pg_xlogfile_name(pg_current_xlog_location()), 1, 8)')
+        return int(cur.fetchone()[0], 16)
+
+    def _get_switch_point(self, conn, timeline):
+        """ Returns the WAL location (as an integer) at which the master server on conn
+            branched off timeline, or None if timeline is not in its history.
+        """
+        cur = conn.cursor()
+        cur.execute('SELECT pg_read_file(%s)', ['pg_xlog/%08X.history' % self._get_timeline(conn)])
+        for line in cur.fetchone()[0].splitlines():
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if int(fields[0]) == timeline:
+                return switch_point_to_int(fields[1])
+        return None
+
+    def _has_diverged(self, master_conn, control_data):
+        """ Returns True if the local data directory contains WAL which the master server
+            on master_conn does not have, i.e. WAL written after the master's timeline
+            branched off ours. Such a data directory can not follow the master.
+        """
+        local_timeline = int(control_data["Latest checkpoint's TimeLineID"])
+        if local_timeline == self._get_timeline(master_conn):
+            return False
+        if control_data['Database cluster state'] not in ('shut down', 'shut down in recovery'):
+            # After a crash the end of the local WAL is unknown
+            self.logger.info('postgresql was not shut down cleanly, assuming timelines have diverged')
+            return True
+        switch_point = self._get_switch_point(master_conn, local_timeline)
+        if switch_point is None:
+            self.logger.info('Timeline %s is not in the master\'s history' % local_timeline)
+            return True
+        # After a clean shutdown the local WAL ends with the shutdown checkpoint record. A
+        # slave may also have replayed WAL up to the minimum recovery ending location.
+        end_of_wal = max(lsn_to_int(control_data['Latest checkpoint location']),
+            lsn_to_int(control_data.get('Minimum recovery ending location', '0/0')))
+        return end_of_wal >= switch_point
+
+    def probe_role(self, hostname):
+        """ Returns MASTER or SLAVE depending on whether the postgresql server on hostname
+            is in recovery, or None if it can not be reached.
+        """
+        try:
+            conn = self._get_conn(host=hostname, user='postgres', connect_timeout=settings.PG_TIMEOUT)
+        except psycopg2.OperationalError:
+            self.logger.warning('Could not connect to %s' % hostname)
+            return None
+        try:
+            return self.SLAVE if self._is_in_recovery(conn) else self.MASTER
+        finally:
+            conn.close()
+
     def check_slave(self):
         """ Returns true if there is a postgresql server running on localhost, and
             the server is in recovery mode (i.e. it is a read slave).
         """
-        # TODO untested
         self.logger.info('Checking slave DB on localhost')
-        conn = self._get_conn()
-        cur = conn.cursor()
-        cur.execute('SELECT pg_is_in_recovery()')
-        res = cur.fetchone()
-        # TODO result won't be a plain string
-        return (res == 't')
+        conn = self._get_conn(user='postgres')
+        try:
+            return self._is_in_recovery(conn)
+        finally:
+            conn.close()
+
+    def _wait_for_slave(self):
+        """ Polls the local server until it is accepting connections as a read-slave, or
+            raises an exception after REJOIN_TIMEOUT seconds.
+        """
+        deadline = time.time() + settings.REJOIN_TIMEOUT
+        while True:
+            try:
+                if self.check_slave():
+                    return
+            except psycopg2.OperationalError:
+                # Still starting up
+                pass
+            if time.time() > deadline:
+                raise Exception('postgresql did not start as a read-slave')
+            time.sleep(1)
 
     def promote(self, force=False):
         """ Promote a read-slave to the master role.
@@ -379,35 +743,206 @@ class PostgresqlCluster(EC2Mixin, BaseCluster):
         try:
             active_master = self.check_master()
         except psycopg2.OperationalError, e:
-            print 'Could not connect to master'
+            self.logger.warning('Could not connect to master')
             active_master = False
 
         if active_master == True:
-            print 'There is an active server at %s' % self.master_cname
+            self.logger.warning('There is an active server at %s' % self.master_cname)
             if force == False:
-                print 'Refusing to promote slave without "force", exiting.'
+                self.logger.critical('Refusing to promote slave without "force", exiting.')
                 return
-        promote_cmd = 'sudo -u postgres %(pg_ctl)s -D %(dir)s promote' % {
-            'user': settings.PG_USER,
-            'pg_ctl': settings.PG_CTL,
-            'dir': settings.PG_DIR}
-        print 'Running promote command: %s' % promote_cmd
-        # TODO error checking, log output
         try:
-            subprocess.check_output(promote_cmd.split(),
-                stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError, e:
+            self.runner.run(self._pg_ctl_cmd('promote'))
+        except CommandError, e:
             if e.output.endswith('server is not in standby mode\n'):
                 self.logger.critical('This server is not in standby mode, so can not be promoted')
+                self.fire_event(events.FAILED, error=e.output)
                 # TODO custom exception?
                 raise Exception(e.output)
             else:
-                print e.output
+                self.fire_event(events.FAILED, error=e.output)
                 raise e
 
         # If we get here, then postgresql should have been successfully promoted.
+        self.role = self.MASTER
+        self.fire_event(events.PROMOTED, master=self.metadata['public-hostname'])
         self.acquire_master_cname(force=True)
         self.remove_from_slave_cname_pool()
 
         # Let's start doing backups
         self.configure_cron_backup()
+
+    def _switchover_failed(self, target, error, resume_as_master=False):
+        """ Reports a failed switchover. If resume_as_master is True the target is known
+            not to have been promoted, and this instance is restarted as the master.
+            Otherwise it is left stopped, as restarting it could leave two masters.
+        """
+        self.fire_event(events.FAILED, error=str(error), target=target)
+        if resume_as_master:
+            self.logger.critical('Switchover to %s failed, restarting as master: %s' % (target, error))
+            try:
+                self.start_process()
+            except Exception, e:
+                self.logger.critical('Failed to restart as master, this instance is stopped: %s' % e)
+        else:
+            self.logger.critical('Switchover to %s failed after it was told to promote, leaving this '
+                'instance stopped. Check %s, then run "ec2cluster reconcile" to point %s at the live '
+                'master: %s' % (target, target, self.master_cname, error))
+
+    def switchover(self, target):
+        """ Hand the master role over to the read-slave at the hostname target.
+
+            This must be run on the current master. Writes are fenced by shutting down
+            this server, the target is promoted as soon as it has replayed all of our
+            WAL, and this instance is then restarted as a read-slave of the new master.
+
+            Returns the write downtime in seconds.
+        """
+        if self.determine_role() != self.MASTER or not self.check_master():
+            self.logger.critical('This instance is not the active master, refusing to switch over')
+            raise Exception('Switchover must be run on the active master')
+
+        target_conn = self._get_conn(host=target, user='postgres')
+        target_conn.autocommit = True
+        if not self._is_in_recovery(target_conn):
+            self.logger.critical('%s is not a read-slave, refusing to switch over' % target)
+            raise Exception('%s is not a read-slave' % target)
+
+        self.logger.info('Fencing writes on %s' % self.metadata['public-hostname'])
+        fenced_at = time.time()
+        try:
+            self.stop_process()
+            control_data = self.get_control_data()
+            if control_data['Database cluster state'] != 'shut down':
+                raise Exception('postgresql is in state "%s" after stopping, expected "shut down"' % (
+                    control_data['Database cluster state']))
+            final_location = control_data['Latest checkpoint location']
+            self.logger.info('Final WAL location on master is %s' % final_location)
+            self._wait_for_replay(target_conn, final_location)
+        except Exception, e:
+            # The target has not been promoted, so it is safe to resume as the master
+            self._switchover_failed(target, e, resume_as_master=True)
+            raise
+
+        # The marker is printed by the remote shell before pg_ctl runs. If it is missing
+        # from the output of a failed ssh command, pg_ctl can not have been run.
+        promote_cmd = settings.SSH_COMMAND + [target, 'echo', self.PROMOTE_MARKER, '&&'] + self._pg_ctl_cmd('promote')
+        try:
+            self.runner.run(promote_cmd)
+        except CommandTimeout, e:
+            # The remote command may have run, so we must not resume as master
+            self._switchover_failed(target, e)
+            raise
+        except CommandError, e:
+            if self.PROMOTE_MARKER not in (e.output or ''):
+                # e.g. ssh could not connect, so the target was never told to promote
+                self._switchover_failed(target, e, resume_as_master=True)
+                raise
+            # ssh may have failed after pg_ctl signalled the target, so whether it is
+            # being promoted is decided by polling it below
+            self.logger.warning('Promote command on %s failed after it was started: %s' % (target, e))
+
+        try:
+            self._wait_for_promotion(target_conn)
+        except Exception, e:
+            # The promote signal may have been delivered, so the target may still leave
+            # recovery later and we must not resume as master
+            self._switchover_failed(target, e)
+            raise
+
+        self.fire_event(events.PROMOTED, master=target)
+        try:
+            self.move_master_cname(target)
+        except Exception, e:
+            self._switchover_failed(target, e)
+            raise
+        downtime = time.time() - fenced_at
+        self.logger.info('Switchover to %s complete, write downtime was %.2f seconds' % (target, downtime))
+
+        # Rejoin the cluster as a read-slave of the new master
+        self.role = self.SLAVE
+        try:
+            self.prepare_slave()
+            self.start_process()
+        except Exception, e:
+            self.logger.critical('Switchover to %s complete (write downtime %.2f seconds), but this instance '
+                'failed to restart as a read-slave. Run "ec2cluster rejoin" once fixed: %s' % (target, downtime, e))
+            self.fire_event(events.FAILED, error=str(e), target=target, downtime=downtime)
+            raise
+        return downtime
+
+    def rewind_data_dir(self):
+        """ Uses pg_rewind to discard the changes this instance made after the timelines
+            diverged. Only the blocks changed since the divergence are copied from the master.
+        """
+        rewind_cmd = ['sudo', '-u', settings.PG_USER, settings.PG_REWIND,
+            '--target-pgdata', settings.PG_DIR,
+            '--source-server', 'host=%s user=postgres' % self.master_cname]
+        self.runner.run(rewind_cmd, timeout=settings.RESYNC_TIMEOUT)
+
+    def rsync_data_dir(self, master_conn):
+        """ Copies the master's data directory over this instance's one using rsync, wrapped
+            in pg_start_backup()/pg_stop_backup(). rsync's delta transfer means only the
+            changed parts of each file are sent. WAL is not copied - the recovered slave
+            fetches it from the master or the archive.
+        """
+        rsync_cmd = [settings.RSYNC, '-a', '--delete', '--delete-excluded',
+            '-e', ' '.join(settings.SSH_COMMAND),
+            '--exclude', 'pg_xlog/*',
+            '--exclude', 'postmaster.pid',
+            '--exclude', 'recovery.conf',
+            '%s:%s/' % (self.master_cname, settings.PG_DIR),
+            '%s/' % settings.PG_DIR]
+        cur = master_conn.cursor()
+        cur.execute("SELECT pg_start_backup('ec2cluster rejoin', true)")
+        try:
+            self.runner.run(rsync_cmd, timeout=settings.RESYNC_TIMEOUT)
+        finally:
+            cur.execute('SELECT pg_stop_backup()')
+
+    def rejoin(self):
+        """ Bring a demoted master (or any stranded instance) back into the cluster as
+            a read-slave of the current master.
+
+            If this instance has WAL from after the point the master's timeline branched
+            off ours, e.g. writes made by an old master after a slave was promoted, the data
+            directory is resynchronised with pg_rewind, falling back to rsync if PG_REWIND
+            is not set or pg_rewind fails.
+        """
+        if self.determine_role() == self.MASTER:
+            self.logger.critical('%s points to this instance, refusing to rejoin as a slave' % self.master_cname)
+            raise Exception('Can not rejoin as a slave while holding the master CNAME')
+
+        master_conn = self._get_conn(host=self.master_cname, user='postgres')
+        master_conn.autocommit = True
+        if self._is_in_recovery(master_conn):
+            self.logger.critical('%s is not a master, refusing to rejoin' % self.master_cname)
+            raise Exception('There is no active master at %s' % self.master_cname)
+
+        if self.is_process_running():
+            self.stop_process()
+
+        try:
+            if self._has_diverged(master_conn, self.get_control_data()):
+                self.logger.info('Timelines have diverged, resynchronising data directory')
+                rewound = False
+                if settings.PG_REWIND and os.path.exists(settings.PG_REWIND):
+                    try:
+                        self.rewind_data_dir()
+                        rewound = True
+                    except CommandError:
+                        self.logger.warning('pg_rewind failed, falling back to rsync')
+                if not rewound:
+                    self.rsync_data_dir(master_conn)
+
+            self.role = self.SLAVE
+            self.prepare_slave()
+            self.start_process()
+            self._wait_for_slave()
+        except Exception, e:
+            self.logger.critical('Failed to rejoin the cluster as a slave, postgresql may be left stopped: %s' % e)
+            self.fire_event(events.FAILED, error=str(e))
+            raise
+        self.add_to_slave_cname_pool()
+        self.fire_event(events.REJOINED)
+        self.logger.info('Rejoined the cluster as a slave of %s' % self.master_cname)
@@ -15,6 +15,31 @@ def promote(args):
     cluster.promote()
 
 
+def switchover(args):
+    """ Hand the master role over to a read-slave with minimal write downtime.
+    """
+    print 'switchover'
+    cluster = PostgresqlCluster()
+    downtime = cluster.switchover(args.to)
+    print 'Switchover to %s complete, write downtime was %.2f seconds' % (args.to, downtime)
+
+
+def rejoin(args):
+    """ Rejoin the cluster as a read-slave, e.g. after this instance was demoted.
+    """
+    print 'rejoin'
+    cluster = PostgresqlCluster()
+    cluster.rejoin()
+
+
+def reconcile(args):
+    """ Correct the master and slave CNAMEs to match the live instances.
+    """
+    print 'reconcile'
+    cluster = PostgresqlCluster()
+    cluster.reconcile_dns(dry_run=args.dry_run, force=args.force)
+
+
 def init(args):
     """ Initialise this instance as a master or slave.
     """
@@ -57,11 +82,26 @@ def main():
     parser_promote.add_argument('--baz', help='promote arg')
     parser_promote.set_defaults(func=promote)
 
+    # switchover command
+    parser_switchover = subparsers.add_parser('switchover', help='Hand the master role to a slave')
+    parser_switchover.add_argument('--to', required=True, help='Public hostname of the slave to promote')
+    parser_switchover.set_defaults(func=switchover)
+
+    # rejoin command
+    parser_rejoin = subparsers.add_parser('rejoin', help='Rejoin the cluster as a slave')
+    parser_rejoin.set_defaults(func=rejoin)
+
+    # reconcile command
+    parser_reconcile = subparsers.add_parser('reconcile', help='Fix DNS records pointing to dead instances')
+    parser_reconcile.add_argument('--dry-run', action='store_true', help='Log the changes without applying them')
+    parser_reconcile.add_argument('--force', action='store_true', help='Allow removing every instance from the slave pool')
+    parser_reconcile.set_defaults(func=reconcile)
+
     default_args = [
         {'name': '--settings', 'help': 'Path to settings file'},
     ]
 
-    _add_default_args([parser_init, parser_promote], default_args)
+    _add_default_args([parser_init, parser_promote, parser_switchover, parser_rejoin, parser_reconcile], default_args)
 
     # Parse the args, and pass them to the function for the chosen subcommand
     args = parser.parse_args()
@@ -5,6 +5,10 @@ MASTER_CNAME = 'master.%(cluster)s.example.com'
 SLAVE_CNAME = 'slave.%(cluster)s.example.com'
 MASTER_CNAME_TTL = '60'
 SLAVE_CNAME_TTL = '60'
+COMMAND_TIMEOUT = 300  # Default time limit for external commands, after which they are killed
+# Where to send role change events, e.g. [{'type': 'webhook', 'url': 'http://example.com/hook'}]
+# See ec2cluster.events.get_sinks for the available sink types.
+EVENT_SINKS = []
 
 # AWS settings
 ROUTE53_ZONE_ID = ''
@@ -19,5 +23,21 @@ RECOVERY_FILENAME = '%s/recovery.conf' % PG_DIR
 RECOVERY_TEMPLATE_SLAVE = '/etc/postgresql/9.1/main/recovery_template_slave.conf'
 RECOVERY_TEMPLATE_MASTER = '/etc/postgresql/9.1/main/recovery_template_master.conf'
 PG_CTL = '/usr/lib/postgresql/9.1/bin/pg_ctl'
+PG_CONTROLDATA = '/usr/lib/postgresql/9.1/bin/pg_controldata'
+# pg_rewind ships with PostgreSQL 9.5 and later, e.g. '/usr/lib/postgresql/9.5/bin/pg_rewind'.
+# If this is None (or does not exist), rejoin resynchronises diverged data directories with rsync.
+PG_REWIND = None
+RSYNC = '/usr/bin/rsync'
 PG_USER = 'postgres'
 PG_TIMEOUT = 20  # Time to wait when attempting to connect to postgres
+PG_START_TIMEOUT = 600  # Starting postgres may involve a long crash recovery
+
+# Switchover settings
+SSH_COMMAND = ['ssh', '-o', 'BatchMode=yes']  # Used to run commands on other instances
+SWITCHOVER_POLL_INTERVAL = 0.1  # Seconds between LSN checks while waiting for the new master
+SWITCHOVER_TIMEOUT = 60  # Give up and resume as master if the slave has not caught up by then
+SWITCHOVER_PROMOTE_TIMEOUT = 600  # Time allowed for the promoted slave to leave recovery, including its checkpoint
+
+# Rejoin settings
+REJOIN_TIMEOUT = 300  # Seconds to wait for a rejoining instance to start as a read-slave
+RESYNC_TIMEOUT = 4 * 60 * 60  # Time limit for pg_rewind or rsync when resynchronising a data directory
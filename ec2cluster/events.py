@@ -0,0 +1,175 @@
+import collections
+import json
+import logging
+import socket
+import threading
+import time
+import urllib2
+
+from ec2cluster.runner import CommandRunner
+
+
+logger = logging.getLogger(__name__)
+
+# Event types
+ROLE_DETERMINED = 'role_determined'
+PROMOTED = 'promoted'
+DNS_UPDATED = 'dns_updated'
+FAILED = 'failed'
+REJOINED = 'rejoined'
+
+EVENT_TYPES = (ROLE_DETERMINED, PROMOTED, DNS_UPDATED, FAILED, REJOINED)
+
+
+class Event(object):
+    """ Something that happened to an instance in the cluster, e.g. it was promoted.
+
+        data is a dict of extra information about the event, and must be JSON-serialisable.
+    """
+    def __init__(self, name, data=None):
+        if name not in EVENT_TYPES:
+            raise ValueError('Unknown event type: %s' % name)
+        self.name = name
+        self.data = data or {}
+        self.timestamp = time.time()
+
+    def to_json(self):
+        payload = dict(self.data)
+        payload.update({'event': self.name, 'timestamp': self.timestamp})
+        return json.dumps(payload)
+
+
+class BaseSink(object):
+    """ Base class for event sinks. send() must give up after self.timeout seconds.
+    """
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+
+    def send(self, event):
+        raise NotImplementedError
+
+
+class ScriptSink(BaseSink):
+    """ Runs a local script with the event name as its only argument. The JSON-encoded
+        event is written to the script's stdin.
+    """
+    def __init__(self, path, timeout=10):
+        super(ScriptSink, self).__init__(timeout)
+        self.path = path
+
+    def send(self, event):
+        CommandRunner(logger).run([self.path, event.name], timeout=self.timeout, input=event.to_json())
+
+
+class UnixSocketSink(BaseSink):
+    """ Writes the JSON-encoded event, followed by a newline, to a UNIX socket.
+    """
+    def __init__(self, path, timeout=10):
+        super(UnixSocketSink, self).__init__(timeout)
+        self.path = path
+
+    def send(self, event):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+            sock.sendall(event.to_json() + '\n')
+        finally:
+            sock.close()
+
+
+class WebhookSink(BaseSink):
+    """ POSTs the JSON-encoded event to a URL.
+    """
+    def __init__(self, url, timeout=10):
+        super(WebhookSink, self).__init__(timeout)
+        self.url = url
+
+    def send(self, event):
+        request = urllib2.Request(self.url, event.to_json(), {'Content-Type': 'application/json'})
+        urllib2.urlopen(request, timeout=self.timeout).read()
+
+
+SINK_TYPES = {
+    'script': ScriptSink,
+    'socket': UnixSocketSink,
+    'webhook': WebhookSink,
+}
+
+
+def get_sinks(config):
+    """ Creates sinks from a list of dicts, as used by the EVENT_SINKS setting:
+
+        EVENT_SINKS = [
+            {'type': 'webhook', 'url': 'http://example.com/hook', 'timeout': 5},
+            {'type': 'socket', 'path': '/var/run/pgbouncer-notify.sock'},
+        ]
+    """
+    sinks = []
+    for sink_config in config:
+        options = dict(sink_config)
+        sink_type = options.pop('type')
+        if sink_type not in SINK_TYPES:
+            raise ValueError('Unknown event sink type: %s' % sink_type)
+        sinks.append(SINK_TYPES[sink_type](**options))
+    return sinks
+
+
+class EventBus(object):
+    """ Delivers events to all registered sinks.
+
+        Each sink has its own queue and worker thread, so a sink receives events in the
+        order they were fired, while a slow sink does not hold up the cluster operation
+        or the other sinks. A worker exits once its queue is empty, and sinks enforce
+        their own timeouts, so pending deliveries never keep the process alive forever.
+    """
+    def __init__(self, sinks=None):
+        self.sinks = []
+        self._queues = []
+        self._workers = []
+        self._lock = threading.Lock()
+        for sink in sinks or []:
+            self.register(sink)
+
+    def register(self, sink):
+        with self._lock:
+            self.sinks.append(sink)
+            self._queues.append(collections.deque())
+            self._workers.append(None)
+
+    def fire(self, event):
+        logger.info('Firing event %s' % event.name)
+        with self._lock:
+            for i, sink in enumerate(self.sinks):
+                self._queues[i].append(event)
+                if self._workers[i] is None:
+                    worker = threading.Thread(target=self._work, args=(i, ))
+                    self._workers[i] = worker
+                    worker.start()
+
+    def _work(self, i):
+        sink = self.sinks[i]
+        while True:
+            with self._lock:
+                if not self._queues[i]:
+                    self._workers[i] = None
+                    return
+                event = self._queues[i].popleft()
+            self._deliver(sink, event)
+
+    def _deliver(self, sink, event):
+        try:
+            sink.send(event)
+        except Exception:
+            logger.exception('Failed to deliver event %s to %s' % (event.name, sink.__class__.__name__))
+
+    def wait(self):
+        """ Blocks until all events fired so far have been delivered (or timed out).
+        """
+        while True:
+            with self._lock:
+                workers = [worker for worker in self._workers if worker is not None]
+            if not workers:
+                return
+            for worker in workers:
+                worker.join()
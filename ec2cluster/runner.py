@@ -0,0 +1,160 @@
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+
+from ec2cluster import settings
+
+
+class CommandError(subprocess.CalledProcessError):
+    """ Raised when a command exits with a non-zero status. output contains stdout and
+        stderr, interleaved in the order they were written.
+    """
+    def __init__(self, returncode, cmd, output=None, duration=None):
+        super(CommandError, self).__init__(returncode, cmd, output)
+        self.duration = duration
+
+
+class CommandTimeout(CommandError):
+    """ Raised when a command is killed because it ran for longer than its timeout.
+    """
+    def __str__(self):
+        return "Command '%s' timed out after %.2f seconds" % (self.cmd, self.duration)
+
+
+class CommandResult(object):
+    def __init__(self, cmd, returncode, output, stdout, duration):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.output = output
+        self.stdout = stdout
+        self.duration = duration
+
+
+class CommandRunner(object):
+    """ Runs external commands.
+
+        Each command runs in its own process group, so if it exceeds its timeout the
+        command and any children it started (e.g. those of an init.d script) are
+        killed. Output is sent to the logger line by line as it is produced, and a
+        CommandResult for every command is kept in self.history.
+    """
+    # Seconds to wait after SIGTERM before sending SIGKILL to a timed out command
+    KILL_GRACE_PERIOD = 5
+    # Seconds to wait for remaining output once the command has exited. Daemons started
+    # by the command may hold its stdout open, and we should not wait for them.
+    OUTPUT_GRACE_PERIOD = 1
+
+    def __init__(self, logger=None, timeout=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.timeout = timeout or settings.COMMAND_TIMEOUT
+        self.history = []
+
+    def run(self, cmd, timeout=None, check=True, env=None, input=None):
+        """ Runs cmd (a list of arguments) and returns a CommandResult.
+
+            If check is True, CommandError is raised if the command exits with a non-zero
+            status. CommandTimeout is always raised if the command times out.
+        """
+        timeout = timeout or self.timeout
+        self.logger.info('Running command: %s' % ' '.join(cmd))
+        started = time.time()
+        devnull = open(os.devnull, 'r')
+        try:
+            proc = subprocess.Popen(cmd,
+                stdin=subprocess.PIPE if input is not None else devnull,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=env,
+                close_fds=True,
+                preexec_fn=os.setsid)
+        finally:
+            devnull.close()
+
+        output = []
+        stdout = []
+        readers = [
+            threading.Thread(target=self._read, args=(proc.stdout, logging.INFO, output, stdout)),
+            threading.Thread(target=self._read, args=(proc.stderr, logging.WARNING, output, None)),
+        ]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+
+        timed_out = threading.Event()
+        timer = threading.Timer(timeout, self._kill, args=(proc, timed_out))
+        timer.start()
+        try:
+            if input is not None:
+                try:
+                    proc.stdin.write(input)
+                    proc.stdin.close()
+                except IOError:
+                    # The command exited without reading all of its input
+                    pass
+            returncode = proc.wait()
+        finally:
+            timer.cancel()
+        for reader in readers:
+            reader.join(self.OUTPUT_GRACE_PERIOD)
+
+        result = CommandResult(cmd, returncode, ''.join(output), ''.join(stdout), time.time() - started)
+        self.history.append(result)
+        self.logger.info('Command %s exited with status %s after %.2f seconds' % (
+            cmd[0], result.returncode, result.duration))
+
+        if timed_out.is_set():
+            self.logger.critical('Command %s timed out after %s seconds' % (cmd[0], timeout))
+            raise CommandTimeout(result.returncode, cmd, result.output, result.duration)
+        if check and result.returncode != 0:
+            raise CommandError(result.returncode, cmd, result.output, result.duration)
+        return result
+
+    def run_many(self, cmds, timeout=None, check=True):
+        """ Runs independent commands concurrently, and returns their CommandResults in
+            the same order as cmds. If any command fails, the first error is raised once
+            all of the commands have finished.
+        """
+        results = [None] * len(cmds)
+        errors = [None] * len(cmds)
+
+        def run(i, cmd):
+            try:
+                results[i] = self.run(cmd, timeout=timeout, check=check)
+            except Exception, e:
+                errors[i] = e
+
+        threads = [threading.Thread(target=run, args=(i, cmd)) for i, cmd in enumerate(cmds)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for error in errors:
+            if error is not None:
+                raise error
+        return results
+
+    def _read(self, pipe, level, output, captured):
+        for line in iter(pipe.readline, ''):
+            self.logger.log(level, line.rstrip('\n'))
+            output.append(line)
+            if captured is not None:
+                captured.append(line)
+        pipe.close()
+
+    def _kill(self, proc, timed_out):
+        timed_out.set()
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+            # returncode is set by proc.wait() in run(), so don't reap the process here
+            deadline = time.time() + self.KILL_GRACE_PERIOD
+            while proc.returncode is None and time.time() < deadline:
+                time.sleep(0.1)
+            if proc.returncode is None:
+                os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            # The process group has already exited
+            pass
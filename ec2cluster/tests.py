@@ -1,10 +1,15 @@
 import sys
+import threading
+import time
 import unittest2
 import mock
 import os
 from mock import patch
 from ec2cluster.base import BaseCluster, PostgresqlCluster, ScriptCluster
 from ec2cluster import settings
+from ec2cluster import events
+from ec2cluster.utils import lsn_to_int, switch_point_to_int
+from ec2cluster.runner import CommandRunner, CommandError, CommandTimeout
 
 
 path = os.path.dirname(__file__)
@@ -31,8 +36,8 @@ class BaseTest(unittest2.TestCase):
     prepare_master=mock.DEFAULT,
     prepare_slave=mock.DEFAULT,
 )
-@patch.multiple('subprocess',
-    check_call=mock.DEFAULT
+@patch.multiple(CommandRunner,
+    run=mock.DEFAULT
 )
 class ScriptClusterTest(BaseTest):
     def test_init_master(self, *args, **kwargs):
@@ -41,7 +46,7 @@ class ScriptClusterTest(BaseTest):
         self.cluster = ScriptCluster()
         self.cluster.initialise()
         kwargs['prepare_master'].assert_called_with()
-        kwargs['check_call'].assert_called_with(['/etc/init.d/testservice', 'start'])
+        kwargs['run'].assert_called_with(['/etc/init.d/testservice', 'start'])
         kwargs['prepare_master'].assert_called_with()
 
     def test_init_slave(self, *args, **kwargs):
@@ -50,7 +55,21 @@ class ScriptClusterTest(BaseTest):
         self.cluster = ScriptCluster()
         self.cluster.initialise()
         kwargs['prepare_slave'].assert_called_with()
-        kwargs['check_call'].assert_called_with(['/etc/init.d/testservice', 'start'])
+        kwargs['run'].assert_called_with(['/etc/init.d/testservice', 'start'])
+
+    def test_init_process_failed(self, *args, **kwargs):
+        kwargs['determine_role'].return_value = BaseCluster.MASTER
+        kwargs['get_metadata'].return_value = self.get_metadata()
+        kwargs['run'].side_effect = CommandError(1, ['/etc/init.d/testservice', 'start'])
+        self.cluster = ScriptCluster()
+        sink = mock.Mock()
+        self.cluster.events.register(sink)
+        with patch.object(ScriptCluster, 'process_failed') as process_failed:
+            self.assertRaises(Exception, self.cluster.initialise)
+            process_failed.assert_called_with()
+        self.cluster.events.wait()
+        fired = [call[0][0].name for call in sink.send.call_args_list]
+        self.assertEqual(fired, [events.ROLE_DETERMINED, events.FAILED])
 
 
 @patch.multiple(PostgresqlCluster,
@@ -63,8 +82,8 @@ class ScriptClusterTest(BaseTest):
     configure_cron_backup=mock.DEFAULT,
 
 )
-@patch.multiple('subprocess',
-    check_call=mock.DEFAULT
+@patch.multiple(CommandRunner,
+    run=mock.DEFAULT
 )
 class PostgresqlClusterTest(BaseTest):
     """ Tests a postgresql cluster.
@@ -89,3 +108,519 @@ class PostgresqlClusterTest(BaseTest):
         self.cluster = PostgresqlCluster()
         self.cluster.initialise()
         kwargs['write_recovery_conf'].assert_called_with(settings.RECOVERY_TEMPLATE_SLAVE)
+
+
+@patch.multiple(PostgresqlCluster,
+    determine_role=mock.DEFAULT,
+    get_metadata=mock.DEFAULT,
+    check_master=mock.DEFAULT,
+    move_master_cname=mock.DEFAULT,
+    write_recovery_conf=mock.DEFAULT,
+    stop_process=mock.DEFAULT,
+    start_process=mock.DEFAULT,
+    get_control_data=mock.DEFAULT,
+    _get_conn=mock.DEFAULT,
+    _is_in_recovery=mock.DEFAULT,
+    _wait_for_replay=mock.DEFAULT,
+    fire_event=mock.DEFAULT,
+)
+@patch.multiple(CommandRunner,
+    run=mock.DEFAULT
+)
+@patch.multiple(settings,
+    SWITCHOVER_POLL_INTERVAL=0,
+    SWITCHOVER_TIMEOUT=0.1,
+    SWITCHOVER_PROMOTE_TIMEOUT=0.1,
+)
+class PostgresqlSwitchoverTest(BaseTest):
+    def setup_master(self, kwargs):
+        kwargs['determine_role'].return_value = BaseCluster.MASTER
+        kwargs['check_master'].return_value = True
+        kwargs['get_metadata'].return_value = self.get_metadata()
+        kwargs['get_control_data'].return_value = {
+            'Database cluster state': 'shut down',
+            'Latest checkpoint location': '0/3000020',
+        }
+        # The target is a slave, and leaves recovery once promoted
+        kwargs['_is_in_recovery'].side_effect = [True, False]
+        self.cluster = PostgresqlCluster()
+
+    def test_switchover(self, *args, **kwargs):
+        self.setup_master(kwargs)
+        self.cluster.switchover('slave-host')
+        kwargs['stop_process'].assert_called_with()
+        kwargs['_wait_for_replay'].assert_called_with(kwargs['_get_conn'].return_value, '0/3000020')
+        self.assertIn('promote', kwargs['run'].call_args[0][0])
+        kwargs['move_master_cname'].assert_called_with('slave-host')
+        kwargs['write_recovery_conf'].assert_called_with(settings.RECOVERY_TEMPLATE_SLAVE)
+        kwargs['start_process'].assert_called_with()
+
+    def test_switchover_slave_not_caught_up(self, *args, **kwargs):
+        self.setup_master(kwargs)
+        kwargs['_wait_for_replay'].side_effect = Exception('timeout')
+        self.assertRaises(Exception, self.cluster.switchover, 'slave-host')
+        # Resumed as master without touching DNS
+        kwargs['start_process'].assert_called_with()
+        self.assertFalse(kwargs['move_master_cname'].called)
+        self.assertFalse(kwargs['write_recovery_conf'].called)
+        self.assert_failed_event(kwargs)
+
+    def assert_failed_event(self, kwargs):
+        fired = [call[0][0] for call in kwargs['fire_event'].call_args_list]
+        self.assertIn(events.FAILED, fired)
+
+    def test_switchover_promote_command_failed_after_signal(self, *args, **kwargs):
+        self.setup_master(kwargs)
+        # ssh disconnected, but pg_ctl promote had already run on the target
+        kwargs['run'].side_effect = CommandError(255, ['ssh'], PostgresqlCluster.PROMOTE_MARKER + '\n')
+        self.cluster.switchover('slave-host')
+        kwargs['move_master_cname'].assert_called_with('slave-host')
+        kwargs['write_recovery_conf'].assert_called_with(settings.RECOVERY_TEMPLATE_SLAVE)
+
+    def test_switchover_promote_command_failed_after_start(self, *args, **kwargs):
+        self.setup_master(kwargs)
+        kwargs['run'].side_effect = CommandError(255, ['ssh'], PostgresqlCluster.PROMOTE_MARKER + '\n')
+        kwargs['_is_in_recovery'].side_effect = None
+        kwargs['_is_in_recovery'].return_value = True
+        self.assertRaises(Exception, self.cluster.switchover, 'slave-host')
+        # pg_ctl may have signalled the target, so it may still promote later
+        self.assertFalse(kwargs['start_process'].called)
+        self.assertFalse(kwargs['move_master_cname'].called)
+        self.assert_failed_event(kwargs)
+
+    def test_switchover_promote_command_timed_out(self, *args, **kwargs):
+        self.setup_master(kwargs)
+        kwargs['run'].side_effect = CommandTimeout(-15, ['ssh'], '', 300)
+        self.assertRaises(CommandTimeout, self.cluster.switchover, 'slave-host')
+        self.assertFalse(kwargs['start_process'].called)
+        self.assert_failed_event(kwargs)
+
+    def test_switchover_ssh_failed(self, *args, **kwargs):
+        self.setup_master(kwargs)
+        kwargs['run'].side_effect = CommandError(255, ['ssh'], 'ssh: connect to host slave-host port 22: Connection refused\n')
+        self.assertRaises(CommandError, self.cluster.switchover, 'slave-host')
+        # The promote command never reached the target, so we resume as master
+        kwargs['start_process'].assert_called_with()
+        self.assertFalse(kwargs['move_master_cname'].called)
+        self.assertFalse(kwargs['write_recovery_conf'].called)
+        self.assert_failed_event(kwargs)
+
+    def test_switchover_stop_failed(self, *args, **kwargs):
+        self.setup_master(kwargs)
+        kwargs['stop_process'].side_effect = CommandTimeout(-15, ['pg_ctl'], '', 300)
+        self.assertRaises(CommandTimeout, self.cluster.switchover, 'slave-host')
+        kwargs['start_process'].assert_called_with()
+        self.assertFalse(kwargs['run'].called)
+        self.assert_failed_event(kwargs)
+
+    def test_switchover_not_shut_down(self, *args, **kwargs):
+        self.setup_master(kwargs)
+        kwargs['get_control_data'].return_value['Database cluster state'] = 'in production'
+        self.assertRaises(Exception, self.cluster.switchover, 'slave-host')
+        self.assertFalse(kwargs['_wait_for_replay'].called)
+        kwargs['start_process'].assert_called_with()
+        self.assert_failed_event(kwargs)
+
+    def test_switchover_restart_as_slave_failed(self, *args, **kwargs):
+        self.setup_master(kwargs)
+        kwargs['start_process'].side_effect = CommandError(1, ['/etc/init.d/postgresql', 'start'])
+        self.assertRaises(CommandError, self.cluster.switchover, 'slave-host')
+        kwargs['move_master_cname'].assert_called_with('slave-host')
+        failed = [call for call in kwargs['fire_event'].call_args_list if call[0][0] == events.FAILED]
+        self.assertIn('downtime', failed[0][1])
+
+    def test_switchover_promotion_timed_out(self, *args, **kwargs):
+        self.setup_master(kwargs)
+        kwargs['_is_in_recovery'].side_effect = None
+        kwargs['_is_in_recovery'].return_value = True
+        self.assertRaises(Exception, self.cluster.switchover, 'slave-host')
+        # The promote signal was sent, so restarting as master could leave two masters
+        self.assertFalse(kwargs['start_process'].called)
+        self.assertFalse(kwargs['move_master_cname'].called)
+        self.assert_failed_event(kwargs)
+
+    def test_switchover_dns_update_failed(self, *args, **kwargs):
+        self.setup_master(kwargs)
+        kwargs['move_master_cname'].side_effect = Exception('Route53 error')
+        self.assertRaises(Exception, self.cluster.switchover, 'slave-host')
+        self.assertFalse(kwargs['start_process'].called)
+        self.assertFalse(kwargs['write_recovery_conf'].called)
+        self.assert_failed_event(kwargs)
+
+
+class EventBusTest(unittest2.TestCase):
+    def test_fire(self):
+        sinks = [mock.Mock(), mock.Mock()]
+        bus = events.EventBus(sinks)
+        event = events.Event(events.PROMOTED, {'master': 'dummy'})
+        bus.fire(event)
+        bus.wait()
+        for sink in sinks:
+            sink.send.assert_called_with(event)
+
+    def test_failing_sink(self):
+        failing_sink = mock.Mock()
+        failing_sink.send.side_effect = Exception('unreachable')
+        sink = mock.Mock()
+        bus = events.EventBus([failing_sink, sink])
+        bus.fire(events.Event(events.FAILED))
+        bus.wait()
+        self.assertTrue(sink.send.called)
+
+    def test_order_per_sink(self):
+        received = []
+        release = threading.Event()
+
+        class SlowSink(events.BaseSink):
+            def send(self, event):
+                # Later events would overtake this one if deliveries ran in parallel
+                if event.name == events.ROLE_DETERMINED:
+                    release.wait(5)
+                received.append(event.name)
+
+        fast_sink = mock.Mock()
+        bus = events.EventBus([SlowSink(), fast_sink])
+        bus.fire(events.Event(events.ROLE_DETERMINED))
+        bus.fire(events.Event(events.PROMOTED))
+        # The fast sink is not held up by the slow one
+        deadline = time.time() + 5
+        while fast_sink.send.call_count < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(fast_sink.send.call_count, 2)
+        self.assertEqual(received, [])
+        release.set()
+        bus.wait()
+        self.assertEqual(received, [events.ROLE_DETERMINED, events.PROMOTED])
+
+    def test_get_sinks(self):
+        sinks = events.get_sinks([
+            {'type': 'webhook', 'url': 'http://example.com/hook', 'timeout': 5},
+            {'type': 'socket', 'path': '/tmp/events.sock'},
+        ])
+        self.assertIsInstance(sinks[0], events.WebhookSink)
+        self.assertEqual(sinks[0].timeout, 5)
+        self.assertIsInstance(sinks[1], events.UnixSocketSink)
+        self.assertRaises(ValueError, events.get_sinks, [{'type': 'carrier-pigeon'}])
+
+    def test_unknown_event(self):
+        self.assertRaises(ValueError, events.Event, 'exploded')
+
+
+class LsnTest(unittest2.TestCase):
+    def test_lsn_to_int(self):
+        self.assertEqual(lsn_to_int('0/3000020'), 0x3000020)
+        self.assertEqual(lsn_to_int('16/B374D848'), (0x16 << 32) + 0xB374D848)
+        self.assertLess(lsn_to_int('0/FFFFFFFF'), lsn_to_int('1/0'))
+
+    def test_switch_point_to_int(self):
+        self.assertEqual(switch_point_to_int('0/3000090'), 0x3000090)
+        # Pre-9.3 history files only record the segment
+        self.assertEqual(switch_point_to_int('000000010000000200000003'), lsn_to_int('2/3000000'))
+
+
+@patch.multiple(PostgresqlCluster,
+    get_metadata=mock.DEFAULT,
+    _get_timeline=mock.DEFAULT,
+)
+class PostgresqlSwitchPointTest(BaseTest):
+    def test_get_switch_point(self, **kwargs):
+        kwargs['get_metadata'].return_value = self.get_metadata()
+        kwargs['_get_timeline'].return_value = 3
+        conn = mock.Mock()
+        conn.cursor.return_value.fetchone.return_value = (
+            '1\t0/3000090\tno recovery target specified\n'
+            '\n'
+            '2\t0/5000120\tno recovery target specified\n', )
+        cluster = PostgresqlCluster()
+        self.assertEqual(cluster._get_switch_point(conn, 2), 0x5000120)
+        conn.cursor.return_value.execute.assert_called_with('SELECT pg_read_file(%s)', ['pg_xlog/00000003.history'])
+        self.assertEqual(cluster._get_switch_point(conn, 4), None)
+
+
+@patch.multiple(PostgresqlCluster,
+    get_metadata=mock.DEFAULT,
+)
+@patch.object(settings, 'SWITCHOVER_POLL_INTERVAL', 0)
+class PostgresqlWaitForReplayTest(BaseTest):
+    def wait_for_replay(self, kwargs, locations, final_location='0/3000020'):
+        kwargs['get_metadata'].return_value = self.get_metadata()
+        conn = mock.Mock()
+        conn.cursor.return_value.fetchone.side_effect = [(location, ) for location in locations]
+        PostgresqlCluster()._wait_for_replay(conn, final_location)
+        return conn.cursor.return_value.fetchone.call_count
+
+    def test_replayed(self, **kwargs):
+        self.assertEqual(self.wait_for_replay(kwargs, [None, '0/3000000', '0/3000020', '0/3000088']), 4)
+
+    @patch.object(settings, 'SWITCHOVER_TIMEOUT', 0)
+    def test_checkpoint_not_replayed(self, **kwargs):
+        # Replaying up to the start of the shutdown checkpoint record is not enough
+        self.assertRaisesRegexp(Exception, 'only replayed', self.wait_for_replay, kwargs, ['0/3000020'] * 1000)
+
+
+@patch.multiple(PostgresqlCluster,
+    determine_role=mock.DEFAULT,
+    get_metadata=mock.DEFAULT,
+    add_to_slave_cname_pool=mock.DEFAULT,
+    write_recovery_conf=mock.DEFAULT,
+    is_process_running=mock.DEFAULT,
+    stop_process=mock.DEFAULT,
+    start_process=mock.DEFAULT,
+    get_control_data=mock.DEFAULT,
+    rewind_data_dir=mock.DEFAULT,
+    rsync_data_dir=mock.DEFAULT,
+    _get_conn=mock.DEFAULT,
+    _get_timeline=mock.DEFAULT,
+    _get_switch_point=mock.DEFAULT,
+    _is_in_recovery=mock.DEFAULT,
+    _wait_for_slave=mock.DEFAULT,
+)
+class PostgresqlRejoinTest(BaseTest):
+    def setup_old_master(self, kwargs, local_timeline, master_timeline, switch_point='0/3000000'):
+        kwargs['determine_role'].return_value = BaseCluster.SLAVE
+        kwargs['get_metadata'].return_value = self.get_metadata()
+        kwargs['is_process_running'].return_value = True
+        kwargs['_is_in_recovery'].return_value = False
+        kwargs['get_control_data'].return_value = {
+            "Latest checkpoint's TimeLineID": str(local_timeline),
+            'Database cluster state': 'shut down',
+            'Latest checkpoint location': '0/3000020',
+            'Minimum recovery ending location': '0/0',
+        }
+        kwargs['_get_timeline'].return_value = master_timeline
+        kwargs['_get_switch_point'].return_value = lsn_to_int(switch_point)
+        self.cluster = PostgresqlCluster()
+
+    def assert_rejoined(self, kwargs):
+        kwargs['stop_process'].assert_called_with()
+        kwargs['write_recovery_conf'].assert_called_with(settings.RECOVERY_TEMPLATE_SLAVE)
+        kwargs['start_process'].assert_called_with()
+        kwargs['add_to_slave_cname_pool'].assert_called_with()
+
+    def test_rejoin_same_timeline(self, *args, **kwargs):
+        self.setup_old_master(kwargs, 1, 1)
+        self.cluster.rejoin()
+        self.assertFalse(kwargs['rewind_data_dir'].called)
+        self.assertFalse(kwargs['rsync_data_dir'].called)
+        self.assert_rejoined(kwargs)
+
+    @patch.object(settings, 'PG_REWIND', '/usr/lib/postgresql/9.5/bin/pg_rewind')
+    @patch('os.path.exists')
+    def test_rejoin_diverged_rewind(self, exists, *args, **kwargs):
+        exists.return_value = True
+        self.setup_old_master(kwargs, 1, 2)
+        self.cluster.rejoin()
+        kwargs['rewind_data_dir'].assert_called_with()
+        self.assertFalse(kwargs['rsync_data_dir'].called)
+        self.assert_rejoined(kwargs)
+
+    @patch('os.path.exists')
+    def test_rejoin_diverged_rsync(self, exists, *args, **kwargs):
+        exists.return_value = False
+        self.setup_old_master(kwargs, 1, 2)
+        self.cluster.rejoin()
+        self.assertFalse(kwargs['rewind_data_dir'].called)
+        kwargs['rsync_data_dir'].assert_called_with(kwargs['_get_conn'].return_value)
+        self.assert_rejoined(kwargs)
+
+    def test_rejoin_diverged_no_rewind(self, *args, **kwargs):
+        # PG_REWIND is unset by default
+        self.setup_old_master(kwargs, 1, 2)
+        self.cluster.rejoin()
+        self.assertFalse(kwargs['rewind_data_dir'].called)
+        kwargs['rsync_data_dir'].assert_called_with(kwargs['_get_conn'].return_value)
+
+    def test_rejoin_after_clean_switchover(self, *args, **kwargs):
+        # The master's timeline branched off after our shutdown checkpoint
+        self.setup_old_master(kwargs, 1, 2, switch_point='0/3000088')
+        self.cluster.rejoin()
+        self.assertFalse(kwargs['rewind_data_dir'].called)
+        self.assertFalse(kwargs['rsync_data_dir'].called)
+        kwargs['_get_switch_point'].assert_called_with(kwargs['_get_conn'].return_value, 1)
+        self.assert_rejoined(kwargs)
+
+    def test_rejoin_after_crash(self, *args, **kwargs):
+        self.setup_old_master(kwargs, 1, 2, switch_point='0/3000088')
+        kwargs['is_process_running'].return_value = False
+        kwargs['get_control_data'].return_value['Database cluster state'] = 'in production'
+        self.cluster.rejoin()
+        self.assertTrue(kwargs['rsync_data_dir'].called)
+
+    def test_rejoin_failed(self, *args, **kwargs):
+        self.setup_old_master(kwargs, 1, 2)
+        kwargs['rsync_data_dir'].side_effect = CommandError(23, ['rsync'])
+        sink = mock.Mock()
+        self.cluster.events.register(sink)
+        self.assertRaises(CommandError, self.cluster.rejoin)
+        self.cluster.events.wait()
+        fired = [call[0][0].name for call in sink.send.call_args_list]
+        self.assertEqual(fired, [events.FAILED])
+        self.assertFalse(kwargs['start_process'].called)
+        self.assertFalse(kwargs['add_to_slave_cname_pool'].called)
+
+    def test_rejoin_refused_on_master(self, *args, **kwargs):
+        self.setup_old_master(kwargs, 1, 2)
+        kwargs['determine_role'].return_value = BaseCluster.MASTER
+        self.assertRaises(Exception, self.cluster.rejoin)
+        self.assertFalse(kwargs['stop_process'].called)
+
+
+class CommandRunnerTest(unittest2.TestCase):
+    def test_run(self):
+        runner = CommandRunner()
+        result = runner.run(['sh', '-c', 'echo out; echo err >&2'])
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.stdout, 'out\n')
+        self.assertIn('err\n', result.output)
+        self.assertEqual(runner.history, [result])
+
+    def test_input(self):
+        result = CommandRunner().run(['cat'], input='some input')
+        self.assertEqual(result.stdout, 'some input')
+
+    def test_failure(self):
+        runner = CommandRunner()
+        self.assertRaises(CommandError, runner.run, ['sh', '-c', 'exit 3'])
+        self.assertEqual(runner.run(['sh', '-c', 'exit 3'], check=False).returncode, 3)
+
+    def test_timeout(self):
+        runner = CommandRunner()
+        # The child sleep must be killed too, otherwise its open stdout would keep us waiting
+        self.assertRaises(CommandTimeout, runner.run, ['sh', '-c', 'sleep 10; echo done'], timeout=0.5)
+        self.assertLess(runner.history[0].duration, 5)
+
+    def test_run_many(self):
+        runner = CommandRunner()
+        results = runner.run_many([['sh', '-c', 'sleep 0.5; echo 1'], ['sh', '-c', 'sleep 0.5; echo 2']])
+        self.assertEqual([result.stdout for result in results], ['1\n', '2\n'])
+        self.assertRaises(CommandError, runner.run_many, [['true'], ['false']])
+
+
+class FakeRecord(object):
+    def __init__(self, name, value, identifier=None, weight=None):
+        self.type = 'CNAME'
+        self.name = name
+        self.resource_records = [value]
+        self.identifier = identifier
+        self.weight = weight
+        self.ttl = '60'
+
+
+@patch.multiple(PostgresqlCluster,
+    get_metadata=mock.DEFAULT,
+    probe_role=mock.DEFAULT,
+    get_instance_states=mock.DEFAULT,
+    _get_route53_conn=mock.DEFAULT,
+)
+@patch('ec2cluster.base.ResourceRecordSets')
+class PostgresqlReconcileTest(BaseTest):
+    def reconcile(self, changes_class, kwargs, roles, states=None, dry_run=False, force=False, records=None):
+        kwargs['get_metadata'].return_value = self.get_metadata()
+        kwargs['probe_role'].side_effect = lambda hostname: roles[hostname]
+        kwargs['get_instance_states'].return_value = states or {'i-2': 'running', 'i-3': 'running'}
+        kwargs['_get_route53_conn'].return_value.get_all_rrsets.return_value = records or [
+            FakeRecord('master.test-cluster.example.com.', 'db1.'),
+            FakeRecord('slave.test-cluster.example.com.', 'db2.', 'i-2', '10'),
+            FakeRecord('slave.test-cluster.example.com.', 'db3.', 'i-3', '10'),
+            FakeRecord('other.example.com.', 'db4.'),
+        ]
+        self.cluster = PostgresqlCluster()
+        self.changes = changes_class.return_value
+        return self.cluster.reconcile_dns(dry_run=dry_run, force=force)
+
+    def test_consistent(self, changes_class, **kwargs):
+        summary = self.reconcile(changes_class, kwargs, {
+            'db1': BaseCluster.MASTER, 'db2': BaseCluster.SLAVE, 'db3': BaseCluster.SLAVE})
+        self.assertEqual(summary, [])
+        self.assertFalse(self.changes.commit.called)
+        # Only the records for this cluster were probed
+        self.assertEqual(kwargs['probe_role'].call_count, 3)
+
+    def test_dead_slave(self, changes_class, **kwargs):
+        summary = self.reconcile(changes_class, kwargs, {
+            'db1': BaseCluster.MASTER, 'db2': BaseCluster.SLAVE, 'db3': None},
+            {'i-2': 'running', 'i-3': 'terminated'})
+        self.assertEqual(summary, [('remove', 'slave.test-cluster.example.com', 'db3')])
+        self.changes.add_change.assert_called_with('DELETE', 'slave.test-cluster.example.com', 'CNAME',
+            ttl='60', weight='10', identifier='i-3')
+        self.changes.commit.assert_called_with()
+
+    def test_dead_master(self, changes_class, **kwargs):
+        summary = self.reconcile(changes_class, kwargs, {
+            'db1': None, 'db2': BaseCluster.MASTER, 'db3': BaseCluster.SLAVE})
+        self.assertEqual(summary, [
+            ('remove', 'slave.test-cluster.example.com', 'db2'),
+            ('set', 'master.test-cluster.example.com', 'db2'),
+        ])
+        self.assertEqual(self.changes.commit.call_count, 1)
+
+    def test_dead_master_only_slave_promoted(self, changes_class, **kwargs):
+        # The only pool member was promoted, so removing it must not count as emptying the pool
+        summary = self.reconcile(changes_class, kwargs, {'db1': None, 'db2': BaseCluster.MASTER}, records=[
+            FakeRecord('master.test-cluster.example.com.', 'db1.'),
+            FakeRecord('slave.test-cluster.example.com.', 'db2.', 'i-2', '10'),
+        ])
+        self.assertEqual(summary, [
+            ('remove', 'slave.test-cluster.example.com', 'db2'),
+            ('set', 'master.test-cluster.example.com', 'db2'),
+        ])
+        self.changes.commit.assert_called_once_with()
+
+    def test_no_live_master(self, changes_class, **kwargs):
+        summary = self.reconcile(changes_class, kwargs, {
+            'db1': None, 'db2': BaseCluster.SLAVE, 'db3': BaseCluster.SLAVE})
+        # The master CNAME is left alone rather than removed
+        self.assertEqual(summary, [])
+
+    def test_dry_run(self, changes_class, **kwargs):
+        summary = self.reconcile(changes_class, kwargs, {
+            'db1': BaseCluster.MASTER, 'db2': None, 'db3': BaseCluster.SLAVE},
+            {'i-3': 'running'}, dry_run=True)
+        self.assertEqual(len(summary), 1)
+        self.assertFalse(self.changes.commit.called)
+
+    def test_unreachable_running_slave(self, changes_class, **kwargs):
+        summary = self.reconcile(changes_class, kwargs, {
+            'db1': BaseCluster.MASTER, 'db2': BaseCluster.SLAVE, 'db3': None})
+        # The probe failed, but EC2 says the instance is running
+        self.assertEqual(summary, [])
+
+    def test_all_probes_failed(self, changes_class, **kwargs):
+        summary = self.reconcile(changes_class, kwargs, {'db1': None, 'db2': None, 'db3': None})
+        self.assertEqual(summary, [])
+        self.assertFalse(self.changes.commit.called)
+
+    def test_empty_pool_refused(self, changes_class, **kwargs):
+        roles = {'db1': BaseCluster.MASTER, 'db2': None, 'db3': None}
+        states = {'i-2': 'stopped', 'i-3': 'terminated'}
+        self.assertRaises(Exception, self.reconcile, changes_class, kwargs, roles, states)
+        self.assertFalse(self.changes.commit.called)
+        summary = self.reconcile(changes_class, kwargs, roles, states, force=True)
+        self.assertEqual(len(summary), 2)
+        self.changes.commit.assert_called_with()
+
+
+@patch.multiple(PostgresqlCluster,
+    get_metadata=mock.DEFAULT,
+    _get_route53_conn=mock.DEFAULT,
+)
+@patch('ec2cluster.base.ResourceRecordSets')
+class PostgresqlMoveMasterCnameTest(BaseTest):
+    def test_move_master_cname(self, changes_class, **kwargs):
+        kwargs['get_metadata'].return_value = self.get_metadata()
+        kwargs['_get_route53_conn'].return_value.get_all_rrsets.return_value = [
+            FakeRecord('master.test-cluster.example.com.', 'db1.'),
+            FakeRecord('slave.test-cluster.example.com.', 'db2.', 'i-2', '10'),
+            FakeRecord('slave.test-cluster.example.com.', 'db3.', 'i-3', '10'),
+        ]
+        changes = changes_class.return_value
+        PostgresqlCluster().move_master_cname('db2')
+
+        self.assertEqual(changes.add_change.call_args_list, [
+            mock.call('DELETE', 'master.test-cluster.example.com', 'CNAME', ttl='60', weight=None, identifier=None),
+            mock.call('CREATE', 'master.test-cluster.example.com', 'CNAME', ttl=settings.MASTER_CNAME_TTL),
+            mock.call('DELETE', 'slave.test-cluster.example.com', 'CNAME', ttl='60', weight='10', identifier='i-2'),
+        ])
+        values = [call[0][0] for call in changes.add_change.return_value.add_value.call_args_list]
+        self.assertEqual(values, ['db1.', 'db2', 'db2.'])
+        changes.commit.assert_called_once_with()
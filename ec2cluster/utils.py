@@ -37,3 +37,29 @@ BASE_LOGGING_CONFIG = {
 
 def configure_logging():
     logging.config.dictConfig(BASE_LOGGING_CONFIG)
+
+
+def lsn_to_int(location):
+    """ Converts a PostgreSQL WAL location such as '16/B374D848' to an integer, so
+        locations can be compared.
+    """
+    high, low = location.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+XLOG_SEG_SIZE = 16 * 1024 * 1024
+
+
+def switch_point_to_int(switch_point):
+    """ Converts the switch point from a timeline history file to an integer, as
+        lsn_to_int does.
+
+        PostgreSQL 9.3+ records a WAL location such as '0/3000090'. Earlier versions
+        only record the name of the WAL segment the timeline switched in, such as
+        '000000010000000000000003', in which case the start of that segment is
+        returned, as the exact location is not known.
+    """
+    if '/' in switch_point:
+        return lsn_to_int(switch_point)
+    log, seg = int(switch_point[8:16], 16), int(switch_point[16:24], 16)
+    return (log << 32) + seg * XLOG_SEG_SIZE